@@ -6,6 +6,12 @@ This script combines multiple markdown files in a logical order into single cons
 
 from pathlib import Path
 import re
+import shutil
+
+# Separator between aggregated files
+SEPARATOR = b"\n\n---\n\n"
+# Chunk size for streaming copies
+COPY_CHUNK_SIZE = 1 << 16
 
 
 def aggregate_documents(source_dir, target_file, section_order=None):
@@ -33,42 +39,29 @@ def aggregate_documents(source_dir, target_file, section_order=None):
     
     # Optionally reorder files
     if section_order:
-        ordered_files = []
-        for filename in section_order:
-            for md_file in md_files:
-                if md_file.name == filename:
-                    ordered_files.append(md_file)
-                    break
-        # Add any files not in the order list
-        for md_file in md_files:
-            if md_file not in ordered_files:
-                ordered_files.append(md_file)
-        md_files = ordered_files
+        # Files not in the order list are appended alphabetically
+        order_idx = {name: i for i, name in enumerate(section_order)}
+        md_files.sort(key=lambda p: (order_idx.get(p.name, len(order_idx)), p.name))
     
     print(f"📄 Aggregating {len(md_files)} files from {source_path.name}")
     
-    # Read and aggregate files
-    aggregated_content = []
-    
-    for i, md_file in enumerate(md_files, 1):
-        print(f"  {i}. {md_file.name}")
-        
-        with open(md_file, "r", encoding="utf-8") as f:
-            content = f.read()
-        
-        # Add separator between files (except before first file)
-        if i > 1:
-            aggregated_content.append("\n\n" + "---\n\n")
-        
-        aggregated_content.append(content)
-    
-    # Write to target file
+    # Stream files directly into the target file
     target_path.parent.mkdir(parents=True, exist_ok=True)
     
-    with open(target_path, "w", encoding="utf-8") as f:
-        f.write("".join(aggregated_content))
+    with open(target_path, "wb") as out:
+        for i, md_file in enumerate(md_files, 1):
+            print(f"  {i}. {md_file.name}")
+            
+            # Add separator between files (except before first file)
+            if i > 1:
+                out.write(SEPARATOR)
+            
+            with open(md_file, "rb") as src:
+                shutil.copyfileobj(src, out, length=COPY_CHUNK_SIZE)
+        
+        total_bytes = out.tell()
     
-    file_size_mb = target_path.stat().st_size / (1024 * 1024)
+    file_size_mb = total_bytes / (1024 * 1024)
     print(f"✅ Successfully created: {target_path} ({file_size_mb:.1f} MB)\n")
     
     return True
@@ -3,12 +3,18 @@ Lädt Stadtgrenzen für Hamburg, Berlin und Rostock vom BKG WFS-Dienst,
 bereinigt die Daten, erstellt 500m Buffer und speichert die Ergebnisse.
 """
 
+import os
 import sys
+from io import BytesIO
 from pathlib import Path
 from urllib.parse import urlencode
 
+# PROJ ohne Netzwerkzugriff initialisieren (vor dem Import von pyproj/geopandas)
+os.environ.setdefault("PROJ_NETWORK", "OFF")
+
 import geopandas as gpd
 import requests
+from pyproj import CRS
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 from config import (
@@ -20,6 +26,9 @@ from config import (
     TARGET_CRS,
 )
 
+# Ziel-CRS einmalig parsen und für alle Transformationen wiederverwenden
+_TARGET_CRS = CRS.from_user_input(TARGET_CRS)
+
 
 def download_city_boundaries(cities: list[str]) -> gpd.GeoDataFrame:
     """
@@ -48,24 +57,24 @@ def download_city_boundaries(cities: list[str]) -> gpd.GeoDataFrame:
     response = requests.get(f"{BKG_WFS_URL}?{urlencode(params)}")
     response.raise_for_status()
 
-    return gpd.read_file(response.content)
+    # Direkt aus dem Speicher lesen (keine temporäre GML-Datei)
+    return gpd.read_file(BytesIO(response.content), engine="pyogrio")
 
 
 def clean_boundaries(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """
     Bereinigt Stadtgrenzen-Daten: entfernt Duplikate, behält nur das größte 
     Polygon pro Stadt (entfernt kleine Inseln), und reprojectiert zu EPSG 25832.
+    Rückgabe im metrischen TARGET_CRS.
     """
     gdf_clean = gdf[["gen", "ags", "geometry"]].drop_duplicates(subset=["gen"])
     
-    # Extrahiere größtes Polygon aus MultiPolygons
-    gdf_clean["geometry"] = gdf_clean.geometry.apply(
-        lambda geom: max(geom.geoms, key=lambda p: p.area) 
-        if geom.geom_type == "MultiPolygon" 
-        else geom
-    )
+    # Extrahiere größtes Polygon aus MultiPolygons (vektorisiert)
+    gdf_exploded = gdf_clean.explode(index_parts=False).reset_index(drop=True)
+    largest_idx = gdf_exploded.geometry.area.groupby(gdf_exploded["gen"]).idxmax()
+    gdf_clean = gdf_exploded.loc[largest_idx].reset_index(drop=True)
     
-    gdf_clean = gdf_clean.to_crs(TARGET_CRS)
+    gdf_clean = gdf_clean.to_crs(_TARGET_CRS)
     
     print(f"Cleaned boundaries: {len(gdf_clean)} cities")
     return gdf_clean
@@ -75,12 +84,12 @@ def create_buffer(
     gdf: gpd.GeoDataFrame, buffer_distance_m: float
 ) -> gpd.GeoDataFrame:
     """
-    Erstellt Buffer um Stadtgrenzen.
+    Erstellt Buffer um Stadtgrenzen. Gibt die Geometrien im metrischen
+    TARGET_CRS zurück (keine Rücktransformation ins Ursprungs-CRS).
     """
-    original_crs = gdf.crs
-    gdf_buffered = gdf.to_crs(TARGET_CRS).copy()
+    # Reprojektion nur, wenn die Daten nicht bereits im Ziel-CRS vorliegen
+    gdf_buffered = gdf.copy() if gdf.crs == _TARGET_CRS else gdf.to_crs(_TARGET_CRS)
     gdf_buffered["geometry"] = gdf_buffered.geometry.buffer(buffer_distance_m)
-    gdf_buffered = gdf_buffered.to_crs(original_crs)
     
     print(f"Created {buffer_distance_m}m buffer around boundaries")
     return gdf_buffered
@@ -101,7 +110,7 @@ def save_boundaries(
         (gdf_buffered, "city_boundaries_500m_buffer.gpkg"),
     ]:
         path = output_dir / filename
-        gdf.to_file(path, driver="GPKG")
+        gdf.to_file(path, driver="GPKG", engine="pyogrio")
         print(f"Saved {filename} to: {path}")
 
 
@@ -9,19 +9,32 @@ Usage:
 """
 
 import json
+import os
 import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
-import geopandas as gpd
+# PROJ ohne Netzwerkzugriff initialisieren (vor dem Import von pyproj/rasterio)
+os.environ.setdefault("PROJ_NETWORK", "OFF")
+
 import numpy as np
 import pandas as pd
 import rasterio
-from rasterio.features import geometry_mask
+from rasterio.errors import WindowError
+from rasterio.features import geometry_window
+from rasterio.windows import Window
 
 # Add parent directory to path for imports
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-from scripts.config import BOUNDARIES_PATH, CHM_DIR, CITIES
+from scripts.config import (
+    BOUNDARIES_PATH,
+    CHM_DIR,
+    CITIES,
+    load_city_geometries,
+    rasterize_city_mask,
+)
 
 # =============================================================================
 # CONFIGURATION
@@ -30,6 +43,10 @@ from scripts.config import BOUNDARIES_PATH, CHM_DIR, CITIES
 CHM_PROCESSED_DIR = CHM_DIR / "processed"
 OUTPUT_DIR = CHM_DIR / "analysis"
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+MASK_CACHE_DIR = OUTPUT_DIR / "masks"
+
+# Kategoriegrenzen für die Werteverteilung (Meter)
+CATEGORY_EDGES_M = [-5.0, -2.0, 0.0, 50.0, 60.0]
 
 
 # =============================================================================
@@ -37,72 +54,179 @@ OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 # =============================================================================
 
 
-def load_chm_and_boundary(city: str) -> tuple[np.ndarray, np.ndarray]:
+def _segment_medians(
+    values: np.ndarray, segments: list[tuple[int, int]]
+) -> list[float | None]:
     """
-    Lädt CHM und erstellt Stadtgrenzen-Maske.
+    Berechnet Mediane zusammenhängender Rangbereiche mit einem np.partition.
 
     Args:
-        city: Stadtname
+        values: 1D-Array der Werte
+        segments: Liste von (start_rang, anzahl) in der sortierten Reihenfolge
 
     Returns:
-        Tuple (chm_array, city_mask)
+        Liste der Mediane (None für leere Bereiche)
     """
-    chm_path = CHM_PROCESSED_DIR / f"CHM_1m_{city}.tif"
+    kth = sorted(
+        {start + offset for start, count in segments if count > 0
+         for offset in ((count - 1) // 2, count // 2)}
+    )
+    if not kth:
+        return [None] * len(segments)
+
+    partitioned = np.partition(values, kth)
+    return [
+        float(0.5 * (partitioned[start + (count - 1) // 2] + partitioned[start + count // 2]))
+        if count > 0 else None
+        for start, count in segments
+    ]
 
-    with rasterio.open(chm_path) as src:
-        chm = src.read(1)
-        transform = src.transform
 
-        # NoData zu NaN
-        if src.nodata is not None:
-            chm = np.where(np.isclose(chm, src.nodata), np.nan, chm).astype(np.float32)
+def _city_mask_cached(
+    city: str,
+    city_geom,
+    out_shape: tuple[int, int],
+    transform,
+    chm_path: Path,
+) -> np.ndarray:
+    """
+    Liefert die Stadtgrenzen-Maske, gecacht als Bit-gepackte .npz-Datei.
 
-    # Stadtgrenzen-Maske
-    boundaries = gpd.read_file(BOUNDARIES_PATH)
-    city_geom = boundaries[boundaries["gen"] == city].geometry.iloc[0]
-    city_mask = ~geometry_mask([city_geom], out_shape=chm.shape, transform=transform)
+    Je Stadt gibt es genau eine Cache-Datei. Der darin gespeicherte Schlüssel
+    enthält die Änderungszeitpunkte von CHM und Stadtgrenzen; passt er nicht
+    mehr (z.B. nach harmonize_chm), wird neu rasterisiert und die Datei
+    überschrieben, sodass sich keine veralteten Masken ansammeln.
 
-    return chm, city_mask
+    Returns:
+        Boolean-Maske (True = innerhalb Stadtgrenze)
+    """
+    key = (
+        f"{city}|{chm_path.stat().st_mtime_ns}|"
+        f"{Path(BOUNDARIES_PATH).stat().st_mtime_ns}|{out_shape}|{tuple(transform)}"
+    )
+    cache_path = MASK_CACHE_DIR / f"mask_{city}.npz"
+
+    if cache_path.exists():
+        try:
+            with np.load(cache_path) as cached:
+                if str(cached["key"]) == key:
+                    packed = cached["mask"]
+                    return (
+                        np.unpackbits(packed, count=out_shape[0] * out_shape[1])
+                        .view(bool)
+                        .reshape(out_shape)
+                    )
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # Beschädigte/unvollständige Cache-Datei: wie Cache-Miss behandeln
+            pass
+
+    city_mask = rasterize_city_mask(city_geom, out_shape, transform)
+
+    # Erst temporär schreiben, dann atomar ersetzen (überschreibt die veraltete Maske)
+    MASK_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.tmp.npz")
+    try:
+        np.savez(tmp_path, mask=np.packbits(city_mask, axis=None), key=np.array(key))
+        os.replace(tmp_path, cache_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    return city_mask
+
+
+def load_chm_and_boundary(
+    city: str, city_geom
+) -> tuple[np.ndarray, np.ndarray, tuple[int, int]]:
+    """
+    Lädt CHM im Fenster der Stadtgrenze und erstellt Stadtgrenzen-Maske.
 
+    Args:
+        city: Stadtname
+        city_geom: Stadtgrenze (ohne Buffer)
 
-def analyze_chm_distribution(chm: np.ndarray, city_mask: np.ndarray, city: str) -> dict:
+    Returns:
+        Tuple (chm_array, city_mask, raster_shape) - chm_array als float32
+        (NoData = NaN) im Fenster der Stadtgrenze, raster_shape = Größe des
+        gesamten CHM-Rasters
+    """
+    chm_path = CHM_PROCESSED_DIR / f"CHM_1m_{city}.tif"
+
+    with rasterio.open(chm_path) as src:
+        # Nur das Bounding-Box-Fenster der Stadtgrenze lesen (auf das Raster begrenzt)
+        window = geometry_window(src, [city_geom], boundless=True)
+        try:
+            window = window.intersection(Window(0, 0, src.width, src.height))
+        except WindowError:
+            raise ValueError(f"Stadtgrenze {city} überlappt das CHM nicht ({chm_path})") from None
+        # Direkt in einen float32-Puffer lesen (keine Zwischenkopien)
+        chm = np.empty((int(window.height), int(window.width)), dtype=np.float32)
+        src.read(1, window=window, out=chm)
+        transform = src.window_transform(window)
+        raster_shape = src.shape
+
+        # NoData zu NaN (in-place, exakter Vergleich nach float32-Cast)
+        if src.nodata is not None and not np.isnan(src.nodata):
+            np.putmask(chm, chm == np.float32(src.nodata), np.nan)
+
+    # Stadtgrenzen-Maske (bezogen auf das gelesene Fenster)
+    city_mask = _city_mask_cached(city, city_geom, chm.shape, transform, chm_path)
+
+    return chm, city_mask, raster_shape
+
+
+def analyze_chm_distribution(
+    chm: np.ndarray, city_mask: np.ndarray, city: str
+) -> dict:
     """
     Analysiert CHM-Verteilung innerhalb Stadtgrenzen.
 
     Args:
-        chm: CHM array
+        chm: CHM array (NaN = NoData)
         city_mask: Boolean-Maske (True = innerhalb Stadtgrenze)
         city: Stadtname
 
     Returns:
         Dict mit Statistiken
     """
-    # Nur Pixel innerhalb Stadtgrenze
-    chm_city = chm[city_mask]
-    valid_mask = ~np.isnan(chm_city)
-    valid_values = chm_city[valid_mask]
+    # Nur gültige Pixel innerhalb Stadtgrenze (eine Maske in-place, ein einziger Gather)
+    valid_mask = np.isnan(chm)
+    np.logical_not(valid_mask, out=valid_mask)
+    valid_mask &= city_mask
+    valid_values = chm[valid_mask]
+    del valid_mask
 
     total_valid = len(valid_values)
 
-    # Negative Werte analysieren
-    negative_mask = valid_values < 0
-    negative_values = valid_values[negative_mask]
-
-    # Kategorisierung negativer Werte
-    very_negative = negative_values < -5  # Starke Artefakte
-    moderate_negative = (negative_values >= -5) & (negative_values < -2)
-    slightly_negative = (negative_values >= -2) & (negative_values < 0)
-
-    # Hohe Werte analysieren
-    high_mask = valid_values > 50
-    high_values = valid_values[high_mask]
-
-    very_high_mask = valid_values > 60
-    very_high_values = valid_values[very_high_mask]
-
-    # Normale Werte (0-50m)
-    normal_mask = (valid_values >= 0) & (valid_values <= 50)
-    normal_values = valid_values[normal_mask]
+    # Kategorisierung aller Werte in einem Durchlauf
+    # 0: <-5m | 1: -5m bis -2m | 2: -2m bis 0m | 3: 0m bis 50m | 4: >50m bis 60m | 5: >60m
+    # Obergrenzen 50m/60m gehören zur unteren Kategorie (normal bzw. hoch)
+    edges = np.array(CATEGORY_EDGES_M, dtype=valid_values.dtype)
+    edges[3:] = np.nextafter(edges[3:], edges.dtype.type(np.inf))
+    categories = np.digitize(valid_values, edges)
+    counts = np.bincount(categories, minlength=len(edges) + 1)
+    sums = np.bincount(categories, weights=valid_values, minlength=len(edges) + 1)
+
+    very_negative_total, moderate_negative_total, slightly_negative_total = (
+        int(c) for c in counts[:3]
+    )
+    negative_total = very_negative_total + moderate_negative_total + slightly_negative_total
+    high_total = int(counts[4:].sum())
+    very_high_total = int(counts[5])
+    normal_total = int(counts[3])
+
+    # Prozentfaktor einmal berechnen
+    inv = 100.0 / total_valid
+
+    # Extremwerte der Randkategorien entsprechen den globalen Extremwerten
+    all_min = float(valid_values.min())
+    all_max = float(valid_values.max())
+
+    # Kategorien sind nach Wert geordnet: Negative belegen die Ränge
+    # [0, negative_total), normale Werte die direkt anschließenden Ränge
+    all_median, negative_median, normal_median = _segment_medians(
+        valid_values,
+        [(0, total_valid), (0, negative_total), (negative_total, normal_total)],
+    )
 
     stats = {
         "city": city,
@@ -111,43 +235,108 @@ def analyze_chm_distribution(chm: np.ndarray, city_mask: np.ndarray, city: str)
         "valid_pixels": int(total_valid),
         "coverage_percent": round(100 * total_valid / city_mask.sum(), 2),
         # Alle gültigen Werte
-        "all_min": round(float(np.min(valid_values)), 2),
-        "all_max": round(float(np.max(valid_values)), 2),
-        "all_mean": round(float(np.mean(valid_values)), 2),
-        "all_median": round(float(np.median(valid_values)), 2),
+        "all_min": round(all_min, 2),
+        "all_max": round(all_max, 2),
+        "all_mean": round(float(sums.sum() / total_valid), 2),
+        "all_median": round(all_median, 2),
         "all_std": round(float(np.std(valid_values)), 2),
         # Negative Werte
-        "negative_total": int(negative_mask.sum()),
-        "negative_percent": round(100 * negative_mask.sum() / total_valid, 2),
-        "negative_min": round(float(np.min(negative_values)), 2) if len(negative_values) > 0 else None,
-        "negative_mean": round(float(np.mean(negative_values)), 2) if len(negative_values) > 0 else None,
-        "negative_median": round(float(np.median(negative_values)), 2) if len(negative_values) > 0 else None,
+        "negative_total": negative_total,
+        "negative_percent": round(negative_total * inv, 2),
+        "negative_min": round(all_min, 2) if negative_total > 0 else None,
+        "negative_mean": round(float(sums[:3].sum() / negative_total), 2) if negative_total > 0 else None,
+        "negative_median": round(negative_median, 2) if negative_total > 0 else None,
         # Kategorien negativer Werte
-        "very_negative_lt_minus5": int(very_negative.sum()),
-        "very_negative_percent": round(100 * very_negative.sum() / total_valid, 2),
-        "moderate_negative_minus5_to_minus2": int(moderate_negative.sum()),
-        "moderate_negative_percent": round(100 * moderate_negative.sum() / total_valid, 2),
-        "slightly_negative_minus2_to_0": int(slightly_negative.sum()),
-        "slightly_negative_percent": round(100 * slightly_negative.sum() / total_valid, 2),
+        "very_negative_lt_minus5": very_negative_total,
+        "very_negative_percent": round(very_negative_total * inv, 2),
+        "moderate_negative_minus5_to_minus2": moderate_negative_total,
+        "moderate_negative_percent": round(moderate_negative_total * inv, 2),
+        "slightly_negative_minus2_to_0": slightly_negative_total,
+        "slightly_negative_percent": round(slightly_negative_total * inv, 2),
         # Hohe Werte
-        "high_gt_50m": int(high_mask.sum()),
-        "high_gt_50m_percent": round(100 * high_mask.sum() / total_valid, 2),
-        "high_mean": round(float(np.mean(high_values)), 2) if len(high_values) > 0 else None,
-        "high_max": round(float(np.max(high_values)), 2) if len(high_values) > 0 else None,
+        "high_gt_50m": high_total,
+        "high_gt_50m_percent": round(high_total * inv, 2),
+        "high_mean": round(float(sums[4:].sum() / high_total), 2) if high_total > 0 else None,
+        "high_max": round(all_max, 2) if high_total > 0 else None,
         # Sehr hohe Werte
-        "very_high_gt_60m": int(very_high_mask.sum()),
-        "very_high_gt_60m_percent": round(100 * very_high_mask.sum() / total_valid, 2),
-        "very_high_max": round(float(np.max(very_high_values)), 2) if len(very_high_values) > 0 else None,
+        "very_high_gt_60m": very_high_total,
+        "very_high_gt_60m_percent": round(very_high_total * inv, 2),
+        "very_high_max": round(all_max, 2) if very_high_total > 0 else None,
         # Normale Werte (0-50m) - "saubere" Vegetation
-        "normal_0_to_50m": int(normal_mask.sum()),
-        "normal_percent": round(100 * normal_mask.sum() / total_valid, 2),
-        "normal_mean": round(float(np.mean(normal_values)), 2) if len(normal_values) > 0 else None,
-        "normal_median": round(float(np.median(normal_values)), 2) if len(normal_values) > 0 else None,
+        "normal_0_to_50m": normal_total,
+        "normal_percent": round(normal_total * inv, 2),
+        "normal_mean": round(float(sums[3] / normal_total), 2) if normal_total > 0 else None,
+        "normal_median": round(normal_median, 2) if normal_total > 0 else None,
     }
 
     return stats
 
 
+def _write_json(data: list[dict], path: Path) -> None:
+    """Schreibt Statistiken als JSON."""
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def print_interpretation(all_stats: list[dict]) -> None:
+    """
+    Gibt die Interpretation der Verteilungsstatistiken aus.
+
+    Args:
+        all_stats: Liste der Statistik-Dicts aller Städte
+    """
+    print("\n")
+    print("=" * 80)
+    print("INTERPRETATION")
+    print("=" * 80)
+    print()
+
+    for stats in all_stats:
+        city = stats["city"]
+        neg_pct = stats["negative_percent"]
+        very_neg_pct = stats["very_negative_percent"]
+        high_pct = stats["high_gt_50m_percent"]
+        very_high_pct = stats["very_high_gt_60m_percent"]
+
+        print(f"{city}:")
+
+        # Negative Werte
+        if neg_pct > 20:
+            print(f"  ⚠️  Hoher Anteil negativer Werte ({neg_pct:.1f}%)")
+            if very_neg_pct > 5:
+                print(f"      → {very_neg_pct:.1f}% stark negativ (<-5m) - vermutlich Wasserflächen")
+            else:
+                print(f"      → Meist leicht negativ - Interpolationsfehler oder Brücken")
+        elif neg_pct > 10:
+            print(f"  ⚠️  Moderater Anteil negativer Werte ({neg_pct:.1f}%)")
+        else:
+            print(f"  ✓  Wenige negative Werte ({neg_pct:.1f}%)")
+
+        # Hohe Werte
+        if very_high_pct > 0.1:
+            print(f"  ⚠️  Viele Ausreißer >60m ({very_high_pct:.2f}%) - Hochhäuser/Messfehler")
+        elif high_pct > 1:
+            print(f"  ⚠️  Einige hohe Werte >50m ({high_pct:.2f}%) - Gebäude/hohe Bäume")
+        else:
+            print(f"  ✓  Wenige hohe Werte >50m ({high_pct:.2f}%)")
+
+        print()
+
+
+def _run_city(
+    city: str, city_geom
+) -> tuple[dict, tuple[int, int], tuple[int, int]]:
+    """
+    Lädt und analysiert eine Stadt (Worker für den Prozess-Pool).
+
+    Returns:
+        Tuple (stats, raster_shape, window_shape) - Größe des CHM-Rasters und
+        des gelesenen Stadtgrenzen-Fensters
+    """
+    chm, city_mask, raster_shape = load_chm_and_boundary(city, city_geom)
+    return analyze_chm_distribution(chm, city_mask, city), raster_shape, chm.shape
+
+
 def main():
     """Hauptfunktion: Analysiert CHM-Verteilung für alle Städte."""
     print("=" * 80)
@@ -158,23 +347,26 @@ def main():
     print("innerhalb der Stadtgrenzen (ohne Buffer)")
     print()
 
-    all_stats = []
+    # Stadtgrenzen einmalig laden (Worker erhalten nur die Geometrie)
+    city_geoms = load_city_geometries()
 
-    for city in CITIES:
-        print(f"\n{'=' * 80}")
-        print(f"Analysiere {city}")
-        print(f"{'=' * 80}")
+    print(f"Lade und analysiere {len(CITIES)} Städte parallel...")
+    with ProcessPoolExecutor(max_workers=len(CITIES)) as executor:
+        results = list(
+            executor.map(_run_city, CITIES, [city_geoms[city] for city in CITIES])
+        )
 
-        # 1. Lade Daten
-        print("\n[1/2] Lade CHM und Stadtgrenzen...")
-        chm, city_mask = load_chm_and_boundary(city)
-        print(f"  CHM Shape: {chm.shape}")
-        print(f"  Pixel in Stadtgrenze: {city_mask.sum():,}")
+    all_stats = [stats for stats, _, _ in results]
 
-        # 2. Analysiere Verteilung
-        print("\n[2/2] Analysiere CHM-Verteilung...")
-        stats = analyze_chm_distribution(chm, city_mask, city)
-        all_stats.append(stats)
+    # Ausgabe in fester Reihenfolge (keine verschachtelten Prints der Worker)
+    for stats, raster_shape, window_shape in results:
+        city = stats["city"]
+        print(f"\n{'=' * 80}")
+        print(f"Ergebnisse {city}")
+        print(f"{'=' * 80}")
+        print(f"  CHM Shape: {raster_shape}")
+        print(f"  Fenster Stadtgrenze: {window_shape}")
+        print(f"  Pixel in Stadtgrenze: {stats['total_pixels_in_boundary']:,}")
 
         print(f"\n  Ergebnisse für {city}:")
         print(f"    Gültige Pixel: {stats['valid_pixels']:,} ({stats['coverage_percent']:.1f}%)")
@@ -243,62 +435,27 @@ def main():
 
     print(summary_df.to_string(index=False))
 
-    # Speichern
-    print("\n")
+    # Speichern im Hintergrund, während die Interpretation ausgegeben wird
+    json_path = OUTPUT_DIR / "chm_distribution_analysis.json"
+    csv_path = OUTPUT_DIR / "chm_distribution_summary.csv"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        json_future = executor.submit(_write_json, all_stats, json_path)
+        csv_future = executor.submit(df.to_csv, csv_path, index=False)
+
+        print_interpretation(all_stats)
+
+        json_future.result()
+        csv_future.result()
+
     print("=" * 80)
     print("SPEICHERN")
     print("=" * 80)
     print()
-
-    # JSON
-    json_path = OUTPUT_DIR / "chm_distribution_analysis.json"
-    with open(json_path, "w") as f:
-        json.dump(all_stats, f, indent=2)
     print(f"✓ JSON gespeichert: {json_path}")
-
-    # CSV
-    csv_path = OUTPUT_DIR / "chm_distribution_summary.csv"
-    df.to_csv(csv_path, index=False)
     print(f"✓ CSV gespeichert: {csv_path}")
-
-    # Empfehlungen
-    print("\n")
-    print("=" * 80)
-    print("INTERPRETATION")
-    print("=" * 80)
     print()
 
-    for stats in all_stats:
-        city = stats["city"]
-        neg_pct = stats["negative_percent"]
-        very_neg_pct = stats["very_negative_percent"]
-        high_pct = stats["high_gt_50m_percent"]
-        very_high_pct = stats["very_high_gt_60m_percent"]
-
-        print(f"{city}:")
-
-        # Negative Werte
-        if neg_pct > 20:
-            print(f"  ⚠️  Hoher Anteil negativer Werte ({neg_pct:.1f}%)")
-            if very_neg_pct > 5:
-                print(f"      → {very_neg_pct:.1f}% stark negativ (<-5m) - vermutlich Wasserflächen")
-            else:
-                print(f"      → Meist leicht negativ - Interpolationsfehler oder Brücken")
-        elif neg_pct > 10:
-            print(f"  ⚠️  Moderater Anteil negativer Werte ({neg_pct:.1f}%)")
-        else:
-            print(f"  ✓  Wenige negative Werte ({neg_pct:.1f}%)")
-
-        # Hohe Werte
-        if very_high_pct > 0.1:
-            print(f"  ⚠️  Viele Ausreißer >60m ({very_high_pct:.2f}%) - Hochhäuser/Messfehler")
-        elif high_pct > 1:
-            print(f"  ⚠️  Einige hohe Werte >50m ({high_pct:.2f}%) - Gebäude/hohe Bäume")
-        else:
-            print(f"  ✓  Wenige hohe Werte >50m ({high_pct:.2f}%)")
-
-        print()
-
     print("=" * 80)
     print("NÄCHSTE SCHRITTE")
     print("=" * 80)
@@ -8,19 +8,32 @@ Usage:
     uv run python scripts/chm/create_chm.py
 """
 
+import io
 import json
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
 from pathlib import Path
 
-import geopandas as gpd
 import numpy as np
 import rasterio
-from rasterio.features import geometry_mask
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
 
 # Add parent directory to path for imports
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-from scripts.config import BOUNDARIES_PATH, CHM_DIR, CHM_RAW_DIR, CITIES
+from scripts.config import (
+    CHM_BLOCK_SIZE,
+    CHM_DIR,
+    CHM_GTIFF_PROFILE,
+    CHM_NODATA,
+    CHM_RAW_DIR,
+    CITIES,
+    load_city_geometries,
+    rasterize_city_mask,
+)
 
 # =============================================================================
 # CONFIGURATION
@@ -29,7 +42,22 @@ from scripts.config import BOUNDARIES_PATH, CHM_DIR, CHM_RAW_DIR, CITIES
 OUTPUT_DIR = CHM_DIR / "processed"
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-NODATA = -9999.0
+NODATA = CHM_NODATA
+
+# Kachelgröße der GeoTIFF-Ausgabe (Schreiben erfolgt in Kachelzeilen)
+BLOCK_SIZE = CHM_BLOCK_SIZE
+
+# Gespeicherte Höhenauflösung (Dezimalstellen in Metern, 2 = Zentimeter)
+CHM_DECIMALS = 2
+
+# Abschnittsgröße der Statistik-Reduktion (1 MB float32, passt in den CPU-Cache)
+STATS_CHUNK_PIXELS = 1 << 18
+
+# Parallele Städte (konservativ: jede Stadt benötigt mehrere GB für DOM/DGM)
+MAX_WORKERS = min(len(CITIES), max(1, (os.cpu_count() or 1) // 4))
+
+# GDAL-Threads je Stadt (Kompression), Kerne auf die parallelen Städte verteilt
+GDAL_NUM_THREADS = max(1, (os.cpu_count() or 1) // MAX_WORKERS)
 
 
 # =============================================================================
@@ -37,94 +65,272 @@ NODATA = -9999.0
 # =============================================================================
 
 
-def load_raster(path: Path) -> tuple[np.ndarray, dict]:
-    """Lädt Raster und gibt Daten + Profil zurück."""
-    with rasterio.open(path) as src:
-        data = src.read(1)
-        profile = src.profile.copy()
+def create_city_mask(
+    city_geom, shape: tuple[int, int], transform
+) -> tuple[np.ndarray, tuple[slice, slice]]:
+    """
+    Rasterisiert die Stadtgrenze (ohne Buffer) auf das CHM-Grid.
+
+    Die Maske wird nur über der Bounding Box der Stadtgrenze erzeugt,
+    nicht über das gesamte (gepufferte) Raster. Die Bounding Box wird auf das
+    Raster begrenzt; liegt die Stadtgrenze ganz außerhalb, ist die Maske leer.
+
+    Returns:
+        Tuple (city_mask, (row_slice, col_slice)) - Maske (True = innerhalb
+        Stadtgrenze) und Position der Bounding Box im CHM-Grid
+    """
+    # Bounding Box in Pixelkoordinaten (nach außen gerundet, auf Raster begrenzt)
+    minx, miny, maxx, maxy = city_geom.bounds
+    col_a, row_a = ~transform * (minx, maxy)
+    col_b, row_b = ~transform * (maxx, miny)
+    row_start = min(max(int(np.floor(min(row_a, row_b))), 0), shape[0])
+    row_stop = max(min(int(np.ceil(max(row_a, row_b))), shape[0]), row_start)
+    col_start = min(max(int(np.floor(min(col_a, col_b))), 0), shape[1])
+    col_stop = max(min(int(np.ceil(max(col_a, col_b))), shape[1]), col_start)
+    bbox = (slice(row_start, row_stop), slice(col_start, col_stop))
+
+    # Keine Überlappung mit dem Raster: leere Maske (0 Pixel in der Stadtgrenze)
+    if row_stop == row_start or col_stop == col_start:
+        return np.zeros((row_stop - row_start, col_stop - col_start), dtype=bool), bbox
+
+    window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    city_mask = rasterize_city_mask(
+        city_geom, (row_stop - row_start, col_stop - col_start), window_transform(window, transform)
+    )
+
+    return city_mask, bbox
+
+
+def nodata_mask(src, data: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    """
+    Bool-Maske der ungültigen Pixel (NaN oder NoData-Wert).
+
+    Mit out wird die Maske in einen vorhandenen Bool-Puffer geschrieben.
+    """
+    mask = np.isnan(data, out=out)
+    if src.nodata is not None and not np.isnan(src.nodata):
+        # Exakter Vergleich: der NoData-Wert ist nach dem float32-Cast exakt darstellbar
+        mask |= data == np.float32(src.nodata)
+    return mask
+
+
+def read_city_values(src, city_mask: np.ndarray, bbox: tuple[slice, slice]) -> np.ndarray:
+    """
+    Liest die gültigen Pixel innerhalb der Stadtgrenze streifenweise.
+
+    Gelesen wird nur die Bounding Box, in an den Kachelzeilen ausgerichteten
+    Streifen (jede Kachel wird einmal dekodiert). Der Ausschnitt wird nie
+    vollständig in den Speicher geladen.
+
+    Args:
+        src: Geöffnetes CHM-Raster
+        city_mask: Stadtgrenzen-Maske (aus create_city_mask)
+        bbox: Position der Maske im Grid (aus create_city_mask)
+
+    Returns:
+        1D-Array der gültigen Pixel innerhalb der Stadtgrenze (float32)
+    """
+    row_slice, col_slice = bbox
+    parts = []
 
-        # NoData zu NaN konvertieren für Berechnungen
-        if src.nodata is not None:
-            data = np.where(np.isclose(data, src.nodata), np.nan, data).astype(np.float32)
+    # Stadtgrenze außerhalb des Rasters: nichts zu lesen
+    if city_mask.size == 0:
+        return np.empty(0, dtype=np.float32)
 
-    return data, profile
+    # Streifen- und Maskenpuffer einmal anlegen und für alle Kachelzeilen wiederverwenden
+    strip_buf = np.empty((BLOCK_SIZE, col_slice.stop - col_slice.start), dtype=np.float32)
+    valid_buf = np.empty(strip_buf.shape, dtype=bool)
+
+    first_row = row_slice.start - row_slice.start % BLOCK_SIZE
+    for tile_row in range(first_row, row_slice.stop, BLOCK_SIZE):
+        start = max(tile_row, row_slice.start)
+        stop = min(tile_row + BLOCK_SIZE, row_slice.stop)
+        window = Window.from_slices((start, stop), (col_slice.start, col_slice.stop))
+        strip = src.read(1, window=window, out=strip_buf[:stop - start])
+
+        strip_valid = nodata_mask(src, strip, out=valid_buf[:stop - start])
+        np.logical_not(strip_valid, out=strip_valid)
+        strip_valid &= city_mask[start - row_slice.start:stop - row_slice.start]
+        parts.append(strip[strip_valid])
+
+    return np.concatenate(parts) if parts else np.empty(0, dtype=np.float32)
 
 
 def compute_chm(dom: np.ndarray, dgm: np.ndarray) -> np.ndarray:
-    """Berechnet CHM = DOM - DGM."""
-    chm = dom - dgm
-    # NaN wo entweder DOM oder DGM NaN ist
-    chm[np.isnan(dom) | np.isnan(dgm)] = np.nan
-    return chm
+    """
+    Berechnet CHM = DOM - DGM in einem Durchlauf.
+
+    Die Differenz wird in den DOM-Puffer geschrieben (DOM wird überschrieben).
+    Ungültige Pixel (NaN/NoData in DOM oder DGM) werden dabei mitgerechnet und
+    müssen über die Maske aus nodata_mask ausgeschlossen werden.
+    """
+    return np.subtract(dom, dgm, out=dom)
+
+
+def partition_quantiles(values: np.ndarray, quantiles: list[float]) -> list[float]:
+    """
+    Berechnet Quantile (lineare Interpolation wie np.quantile) mit einer
+    einzigen In-place-Partitionierung.
+
+    Achtung: values wird dabei teilweise umsortiert.
 
+    Args:
+        values: 1D-Array ohne NaN
+        quantiles: Quantile im Bereich [0, 1]
 
-def compute_statistics(chm: np.ndarray, city_mask: np.ndarray, city: str) -> dict:
+    Returns:
+        Liste der Quantilwerte
+    """
+    positions = [q * (values.size - 1) for q in quantiles]
+    kth = sorted({int(np.floor(pos)) for pos in positions} | {int(np.ceil(pos)) for pos in positions})
+    values.partition(kth)
+
+    result = []
+    for pos in positions:
+        low, high = int(np.floor(pos)), int(np.ceil(pos))
+        low_value, high_value = float(values[low]), float(values[high])
+        result.append(low_value + (high_value - low_value) * (pos - low))
+    return result
+
+
+def compute_statistics(valid_values: np.ndarray, pixels_total: int, city: str) -> dict:
     """
     Berechnet Statistiken für CHM innerhalb der Stadtgrenzen (ohne Buffer).
 
+    Achtung: valid_values wird dabei teilweise umsortiert.
+
     Args:
-        chm: CHM array
-        city_mask: Boolean-Maske (True = innerhalb Stadtgrenze)
+        valid_values: 1D-Array der gültigen CHM-Pixel innerhalb der Stadtgrenze (ohne NaN)
+        pixels_total: Anzahl aller Pixel innerhalb der Stadtgrenze
         city: Stadtname
 
     Returns:
         Dict mit Statistiken
     """
-    # Nur Pixel innerhalb der Stadtgrenze
-    chm_city = chm[city_mask]
-    valid_mask = ~np.isnan(chm_city)
-    valid_values = chm_city[valid_mask]
-
-    pixels_total = city_mask.sum()
-    pixels_valid = valid_mask.sum()
+    pixels_valid = valid_values.size
     coverage_pct = 100 * pixels_valid / pixels_total if pixels_total > 0 else 0
 
-    # Statistiken
+    # Statistiken (Min/Max und alle Quantile aus einer Partitionierung)
+    has_values = len(valid_values) > 0
+    if has_values:
+        # Mittelwert einmal berechnen und für die Standardabweichung wiederverwenden
+        mean = float(valid_values.mean())
+
+        # Quadratsumme und Schwellwert-Zählungen in einem Durchgang über
+        # cache-große Abschnitte (keine Temporärkopie des gesamten Arrays)
+        squared_sum = 0.0
+        negative_pixels = 0
+        pixels_above_60m = 0
+        for start in range(0, valid_values.size, STATS_CHUNK_PIXELS):
+            chunk = valid_values[start:start + STATS_CHUNK_PIXELS]
+            deviations = np.subtract(chunk, np.float32(mean))
+            squared_sum += float(np.dot(deviations, deviations))
+            negative_pixels += int(np.count_nonzero(chunk < 0))
+            pixels_above_60m += int(np.count_nonzero(chunk > 60))
+        std = float(np.sqrt(squared_sum / valid_values.size))
+
+        vmin, p25, median, p75, p95, vmax = partition_quantiles(
+            valid_values, [0.0, 0.25, 0.5, 0.75, 0.95, 1.0]
+        )
+
     stats = {
         "city": city,
         "pixels_in_boundary": int(pixels_total),
         "pixels_valid": int(pixels_valid),
         "coverage_percent": round(coverage_pct, 2),
-        "min": round(float(np.min(valid_values)), 2) if len(valid_values) > 0 else None,
-        "max": round(float(np.max(valid_values)), 2) if len(valid_values) > 0 else None,
-        "mean": round(float(np.mean(valid_values)), 2) if len(valid_values) > 0 else None,
-        "median": round(float(np.median(valid_values)), 2) if len(valid_values) > 0 else None,
-        "std": round(float(np.std(valid_values)), 2) if len(valid_values) > 0 else None,
-        "p25": (
-            round(float(np.percentile(valid_values, 25)), 2) if len(valid_values) > 0 else None
-        ),
-        "p75": (
-            round(float(np.percentile(valid_values, 75)), 2) if len(valid_values) > 0 else None
-        ),
-        "p95": (
-            round(float(np.percentile(valid_values, 95)), 2) if len(valid_values) > 0 else None
-        ),
-        "negative_pixels": int(np.sum(valid_values < 0)) if len(valid_values) > 0 else 0,
-        "pixels_above_60m": int(np.sum(valid_values > 60)) if len(valid_values) > 0 else 0,
+        "min": round(vmin, 2) if has_values else None,
+        "max": round(vmax, 2) if has_values else None,
+        "mean": round(mean, 2) if has_values else None,
+        "median": round(median, 2) if has_values else None,
+        "std": round(std, 2) if has_values else None,
+        "p25": round(p25, 2) if has_values else None,
+        "p75": round(p75, 2) if has_values else None,
+        "p95": round(p95, 2) if has_values else None,
+        "negative_pixels": negative_pixels if has_values else 0,
+        "pixels_above_60m": pixels_above_60m if has_values else 0,
     }
 
     return stats
 
 
-def save_chm(chm: np.ndarray, profile: dict, output_path: Path) -> None:
-    """Speichert CHM als GeoTIFF."""
-    # NaN zurück zu NoData konvertieren
-    chm_output = np.where(np.isnan(chm), NODATA, chm).astype(np.float32)
+def create_chm_blockwise(
+    dom_src, dgm_src, output_path: Path, city_mask: np.ndarray, bbox: tuple[slice, slice]
+) -> tuple[np.ndarray, dict]:
+    """
+    Berechnet CHM = DOM - DGM streifenweise und schreibt es direkt als GeoTIFF.
+
+    DOM und DGM werden nie vollständig geladen: pro Kachelzeile (BLOCK_SIZE
+    Zeilen) werden beide gelesen, subtrahiert und sofort geschrieben. Nur die
+    gültigen Pixel innerhalb der Stadtgrenze werden für die Statistik gesammelt.
+
+    Args:
+        dom_src: Geöffnetes DOM-Raster
+        dgm_src: Geöffnetes DGM-Raster (gleiches Grid wie DOM)
+        output_path: Ziel-GeoTIFF
+        city_mask: Stadtgrenzen-Maske (aus create_city_mask)
+        bbox: Position der Maske im Grid (aus create_city_mask)
 
+    Returns:
+        Tuple (valid_values, valid_counts) - gültige CHM-Pixel innerhalb der
+        Stadtgrenze (wie gespeichert gerundet) und Anzahl gültiger Pixel je Raster
+    """
+    profile = dom_src.profile.copy()
+    # Gemeinsame Schreibparameter (zstd, Prädiktor, Kacheln) aus der Konfiguration
     profile.update(
-        dtype=rasterio.float32,
-        nodata=NODATA,
-        compress="lzw",
-        tiled=True,
-        blockxsize=256,
-        blockysize=256,
+        dtype=rasterio.float32, nodata=NODATA, num_threads=GDAL_NUM_THREADS, **CHM_GTIFF_PROFILE
     )
 
-    with rasterio.open(output_path, "w", **profile) as dst:
-        dst.write(chm_output, 1)
+    height, width = dom_src.shape
+    row_slice, col_slice = bbox
+    city_parts = []
+    valid_counts = {"dom": 0, "dgm": 0, "chm": 0}
 
+    # Streifen- und Maskenpuffer einmal anlegen und für alle Kachelzeilen wiederverwenden
+    # (Randstreifen nutzen die ersten Zeilen; keine Allokation pro Streifen)
+    dom_buf = np.empty((BLOCK_SIZE, width), dtype=np.float32)
+    dgm_buf = np.empty_like(dom_buf)
+    invalid_buf = np.empty(dom_buf.shape, dtype=bool)
+    dgm_invalid_buf = np.empty_like(invalid_buf)
 
-def process_city(city: str) -> dict | None:
+    with rasterio.open(output_path, "w", **profile) as dst:
+        for row in range(0, height, BLOCK_SIZE):
+            window = Window(0, row, width, min(BLOCK_SIZE, height - row))
+            rows = window.height
+            dom = dom_src.read(1, window=window, out=dom_buf[:rows])
+            dgm = dgm_src.read(1, window=window, out=dgm_buf[:rows])
+
+            # NoData-Masken einmal bestimmen und für Zählung, NaN und NoData wiederverwenden
+            invalid = nodata_mask(dom_src, dom, out=invalid_buf[:rows])
+            dgm_invalid = nodata_mask(dgm_src, dgm, out=dgm_invalid_buf[:rows])
+            valid_counts["dom"] += invalid.size - int(np.count_nonzero(invalid))
+            valid_counts["dgm"] += dgm_invalid.size - int(np.count_nonzero(dgm_invalid))
+            invalid = np.logical_or(invalid, dgm_invalid, out=invalid)
+            valid_counts["chm"] += invalid.size - int(np.count_nonzero(invalid))
+
+            # Differenz direkt auf den Rohwerten (ungültige Pixel über invalid maskiert)
+            chm = compute_chm(dom, dgm)
+            # Auf Zentimeter quantisieren (weniger Mantissen-Rauschen → bessere Kompression),
+            # vor dem Sammeln, damit die Statistiken die gespeicherten Werte beschreiben
+            np.round(chm, CHM_DECIMALS, out=chm)
+
+            # Gültige Pixel innerhalb der Stadtgrenze sammeln (Überlappung Streifen/Bounding Box)
+            start = max(row, row_slice.start)
+            stop = min(row + window.height, row_slice.stop)
+            if start < stop:
+                strip_valid = np.logical_not(invalid[start - row:stop - row, col_slice])
+                strip_valid &= city_mask[start - row_slice.start:stop - row_slice.start]
+                city_parts.append(chm[start - row:stop - row, col_slice][strip_valid])
+
+            # NaN zurück zu NoData konvertieren
+            np.putmask(chm, invalid, NODATA)
+
+            dst.write(chm, 1, window=window)
+
+    valid_values = np.concatenate(city_parts) if city_parts else np.empty(0, dtype=np.float32)
+    return valid_values, valid_counts
+
+
+def process_city(city: str, city_geom) -> dict | None:
     """Verarbeitet eine Stadt und gibt Statistiken zurück. Skippt bereits verarbeitete Städte."""
     print(f"\n{'=' * 60}")
     print(f"Verarbeite {city}")
@@ -136,8 +342,11 @@ def process_city(city: str) -> dict | None:
     chm_output_path = OUTPUT_DIR / f"CHM_1m_{city}.tif"
     stats_path = OUTPUT_DIR / f"stats_{city_lower}.json"
 
-    # Prüfe ob CHM und Stats bereits vorhanden sind
-    if chm_output_path.exists() and stats_path.exists():
+    # Prüfe einmalig, ob CHM und Stats bereits vorhanden sind
+    chm_exists = chm_output_path.exists()
+    stats_exists = stats_path.exists()
+
+    if chm_exists and stats_exists:
         print(f"✓ {city} bereits verarbeitet (CHM und Stats existieren)")
         try:
             with open(stats_path, "r") as f:
@@ -147,11 +356,14 @@ def process_city(city: str) -> dict | None:
             print(f"⚠️ Fehler beim Laden der Stats: {e}. Neu berechnen...")
 
     # Falls Stats fehlen aber CHM existiert: Lade CHM und berechne nur Stats
-    if chm_output_path.exists() and not stats_path.exists():
+    if chm_exists and not stats_exists:
         print(f"✓ CHM existiert bereits")
-        print("\n[1/2] Lade CHM...")
+        print("\n[1/2] Erstelle Stadtgrenzen-Maske und lese CHM-Pixel streifenweise...")
         try:
-            chm, _ = load_raster(chm_output_path)
+            with rasterio.open(chm_output_path) as src:
+                # Nur die Bounding Box der Stadtgrenze lesen (Statistiken benötigen nicht mehr)
+                city_mask, bbox = create_city_mask(city_geom, src.shape, src.transform)
+                valid_values = read_city_values(src, city_mask, bbox)
         except Exception as e:
             print(f"⚠️ CHM-Datei beschädigt ({e}). Lösche und erstelle neu...")
             try:
@@ -159,17 +371,11 @@ def process_city(city: str) -> dict | None:
             except Exception:
                 pass
             # Fortfahren zur vollständigen Neuerstellung
-            chm = None
+            valid_values = None
         
-        if chm is not None:
-            print("\n[2/2] Erstelle Stadtgrenzen-Maske und berechne Statistiken...")
-            boundaries = gpd.read_file(BOUNDARIES_PATH)
-            city_geom = boundaries[boundaries["gen"] == city].geometry.iloc[0]
-            
-            with rasterio.open(chm_output_path) as src:
-                city_mask = ~geometry_mask([city_geom], out_shape=chm.shape, transform=src.transform)
-            
-            stats = compute_statistics(chm, city_mask, city)
+        if valid_values is not None:
+            print("\n[2/2] Berechne Statistiken...")
+            stats = compute_statistics(valid_values, int(np.count_nonzero(city_mask)), city)
             
             print(f"\n  Ergebnis für {city}:")
             print(f"    Coverage: {stats['coverage_percent']:.1f}%")
@@ -186,41 +392,49 @@ def process_city(city: str) -> dict | None:
             
             return stats
 
-    # 1. Lade DOM und DGM
-    print("\n[1/4] Lade DOM und DGM...")
-    dom, dom_profile = load_raster(dom_path)
-    dgm, dgm_profile = load_raster(dgm_path)
-
-    # Prüfe ob Dimensionen übereinstimmen (sollten nach Harmonisierung identisch sein)
-    if dom.shape != dgm.shape:
-        raise ValueError(
-            f"Shape mismatch: DOM {dom.shape} vs DGM {dgm.shape}. "
-            "Bitte zuerst harmonize_elevation.py ausführen!"
+    # 1. Öffne DOM und DGM
+    print("\n[1/3] Öffne DOM und DGM...")
+    with rasterio.open(dom_path) as dom_src, rasterio.open(dgm_path) as dgm_src:
+        # Prüfe ob Dimensionen übereinstimmen (sollten nach Harmonisierung identisch sein)
+        if dom_src.shape != dgm_src.shape:
+            raise ValueError(
+                f"Shape mismatch: DOM {dom_src.shape} vs DGM {dgm_src.shape}. "
+                "Bitte zuerst harmonize_elevation.py ausführen!"
+            )
+
+        # Gleiche Form reicht nicht: verschobene Grids würden Pixel falsch paaren
+        if not dom_src.transform.almost_equals(dgm_src.transform, precision=1e-6):
+            raise ValueError(
+                f"Transform mismatch: DOM {tuple(dom_src.transform)[:6]} vs "
+                f"DGM {tuple(dgm_src.transform)[:6]}. "
+                "Bitte zuerst harmonize_elevation.py ausführen!"
+            )
+
+        print(f"  Shape: {dom_src.height} x {dom_src.width}")
+
+        # 2. Erstelle Stadtgrenzen-Maske (ohne Buffer)
+        print("\n[2/3] Erstelle Stadtgrenzen-Maske...")
+        city_mask, bbox = create_city_mask(city_geom, dom_src.shape, dom_src.transform)
+        pixels_in_boundary = int(np.count_nonzero(city_mask))
+
+        print(f"  Pixel innerhalb Stadtgrenze: {pixels_in_boundary:,}")
+
+        # 3. Berechne und speichere CHM (blockweise)
+        print("\n[3/3] Berechne CHM (DOM - DGM) blockweise und speichere...")
+        valid_values, valid_counts = create_chm_blockwise(
+            dom_src, dgm_src, chm_output_path, city_mask, bbox
         )
 
-    print(f"  Shape: {dom.shape[0]} x {dom.shape[1]}")
-    print(f"  DOM valid: {np.sum(~np.isnan(dom)):,} pixels")
-    print(f"  DGM valid: {np.sum(~np.isnan(dgm)):,} pixels")
+    print(f"  DOM valid: {valid_counts['dom']:,} pixels")
+    print(f"  DGM valid: {valid_counts['dgm']:,} pixels")
+    print(f"  CHM valid: {valid_counts['chm']:,} pixels")
 
-    # 2. Berechne CHM
-    print("\n[2/4] Berechne CHM (DOM - DGM)...")
-    chm = compute_chm(dom, dgm)
-    valid_chm = np.sum(~np.isnan(chm))
-    print(f"  CHM valid: {valid_chm:,} pixels")
+    file_size_mb = chm_output_path.stat().st_size / (1024**2)
+    print(f"  ✓ Gespeichert: {chm_output_path.name} ({file_size_mb:.1f} MB)")
 
-    # 3. Erstelle Stadtgrenzen-Maske (ohne Buffer)
-    print("\n[3/4] Erstelle Stadtgrenzen-Maske...")
-    boundaries = gpd.read_file(BOUNDARIES_PATH)
-    city_geom = boundaries[boundaries["gen"] == city].geometry.iloc[0]
-
-    with rasterio.open(dom_path) as src:
-        city_mask = ~geometry_mask([city_geom], out_shape=dom.shape, transform=src.transform)
-
-    print(f"  Pixel innerhalb Stadtgrenze: {city_mask.sum():,}")
-
-    # 4. Berechne Statistiken (nur innerhalb Stadtgrenze)
-    print("\n[4/4] Berechne Statistiken...")
-    stats = compute_statistics(chm, city_mask, city)
+    # Statistiken (nur innerhalb Stadtgrenze)
+    stats = compute_statistics(valid_values, pixels_in_boundary, city)
+    del valid_values
 
     print(f"\n  Ergebnis für {city}:")
     print(f"    Coverage: {stats['coverage_percent']:.1f}%")
@@ -230,14 +444,6 @@ def process_city(city: str) -> dict | None:
     print(f"    Negative Pixel: {stats['negative_pixels']:,}")
     print(f"    Pixel >60m: {stats['pixels_above_60m']:,}")
 
-    # 5. Speichere CHM
-    output_path = OUTPUT_DIR / f"CHM_1m_{city}.tif"
-    print(f"\n  Speichere CHM: {output_path.name}")
-    save_chm(chm, dom_profile, output_path)
-
-    file_size_mb = output_path.stat().st_size / (1024**2)
-    print(f"  ✓ Gespeichert ({file_size_mb:.1f} MB)")
-
     # Speichere Statistiken als JSON
     with open(stats_path, "w") as f:
         json.dump(stats, f, indent=2)
@@ -246,6 +452,14 @@ def process_city(city: str) -> dict | None:
     return stats
 
 
+def _run_city(city: str, city_geom) -> tuple[dict | None, str]:
+    """Worker: Verarbeitet eine Stadt und sammelt ihre Ausgabe, statt sie direkt zu drucken."""
+    log = io.StringIO()
+    with redirect_stdout(log):
+        stats = process_city(city, city_geom)
+    return stats, log.getvalue()
+
+
 def main():
     """Hauptfunktion: Verarbeitet alle Städte."""
     print("=" * 70)
@@ -257,12 +471,20 @@ def main():
     print("  → NoData = -9999")
     print()
 
-    all_stats = []
+    # Stadtgrenzen einmalig laden (Worker erhalten nur die Geometrie)
+    city_geoms = load_city_geometries()
+
+    # Städte parallel verarbeiten; Ausgaben gesammelt in CITIES-Reihenfolge drucken
+    results = []
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for stats, log in executor.map(
+            _run_city, CITIES, [city_geoms[city] for city in CITIES]
+        ):
+            print(log, end="")
+            results.append(stats)
 
-    for city in CITIES:
-        stats = process_city(city)
-        if stats is not None:  # Nur nicht-übersprungene Städte zur Zusammenfassung hinzufügen
-            all_stats.append(stats)
+    # Nur nicht-übersprungene Städte zur Zusammenfassung hinzufügen
+    all_stats = [stats for stats in results if stats is not None]
 
     # Zusammenfassung
     print("\n")
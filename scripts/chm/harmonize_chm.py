@@ -13,37 +13,59 @@ Usage:
     uv run python scripts/chm/harmonize_chm.py
 """
 
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
 
 # Add parent directory to path for imports
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-from scripts.config import CHM_DIR, CITIES
+from scripts.config import CHM_BLOCK_SIZE, CHM_DIR, CHM_GTIFF_PROFILE, CHM_NODATA, CITIES
 
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
 
 CHM_PROCESSED_DIR = CHM_DIR / "processed"
-NODATA = -9999.0
+NODATA = CHM_NODATA
+
+# Kachelgröße der GeoTIFF-Ausgabe (Schreiben erfolgt in Kachelzeilen)
+BLOCK_SIZE = CHM_BLOCK_SIZE
 
 # Filter-Schwellwerte
 SLIGHTLY_NEGATIVE_MIN = -2.0  # -2m bis 0m → 0 setzen
 MAX_REALISTIC_HEIGHT = 50.0  # >50m → NoData
 
+# Interne Übersichten (Pyramiden) der finalen CHM-Datei
+OVERVIEW_FACTORS = [2, 4, 8, 16]
+
+# Abschnittsgröße der Filterung (1 MB float32, passt in den CPU-Cache)
+FILTER_CHUNK_PIXELS = 1 << 18
+
+# Parallele Städte (jede Stadt liest und schreibt ihr CHM streifenweise)
+MAX_WORKERS = min(len(CITIES), os.cpu_count() or 1)
+
+# GDAL-Threads je Stadt (Kompression, Übersichten), Kerne auf die parallelen Städte verteilt
+GDAL_NUM_THREADS = max(1, (os.cpu_count() or 1) // MAX_WORKERS)
+
 
 # =============================================================================
 # FUNCTIONS
 # =============================================================================
 
 
-def apply_chm_filters(chm: np.ndarray) -> tuple[np.ndarray, dict]:
+def _filter_chunks(chm: np.ndarray) -> np.ndarray:
     """
-    Wendet Qualitätsfilter auf CHM an.
+    Filtert ein zusammenhängendes CHM-Array in-place über cache-große Abschnitte.
+
+    Entfernte und ursprünglich ungültige (NaN) Pixel werden im selben
+    Durchgang auf NODATA gesetzt.
 
     Filter:
     - 0 bis -2m → 0 (leichte Artefakte)
@@ -51,42 +73,53 @@ def apply_chm_filters(chm: np.ndarray) -> tuple[np.ndarray, dict]:
     - > 50m → NoData (Hochhäuser, unrealistisch)
 
     Args:
-        chm: CHM array (NaN = NoData)
+        chm: CHM array (NaN = NoData, C-zusammenhängend)
 
     Returns:
-        Tuple (filtered_chm, filter_stats)
+        Zähler [NaN, negativ, stark negativ, sehr hoch] (vor der Filterung)
     """
-    # Kopie erstellen
-    chm_filtered = chm.copy()
+    # Flache Sicht (ohne Kopie, da zusammenhängend)
+    chm_flat = chm.reshape(-1)
+    counts = np.zeros(4, dtype=np.int64)
+
+    for start in range(0, chm_flat.size, FILTER_CHUNK_PIXELS):
+        chunk = chm_flat[start:start + FILTER_CHUNK_PIXELS]
+
+        # Masken des Abschnitts (NaN ist in keiner Vergleichsmaske enthalten)
+        negative = chunk < 0
+        very_negative = chunk < SLIGHTLY_NEGATIVE_MIN
+        very_high = chunk > MAX_REALISTIC_HEIGHT
 
-    # Original-Statistiken
-    valid_mask = ~np.isnan(chm)
-    original_valid_count = valid_mask.sum()
+        nan_mask = np.isnan(chunk)
 
-    # Zähle betroffene Pixel vor Filterung
-    slightly_negative = (chm >= SLIGHTLY_NEGATIVE_MIN) & (chm < 0)
-    very_negative = chm < SLIGHTLY_NEGATIVE_MIN
-    very_high = chm > MAX_REALISTIC_HEIGHT
+        counts[0] += np.count_nonzero(nan_mask)
+        counts[1] += np.count_nonzero(negative)
+        counts[2] += np.count_nonzero(very_negative)
+        counts[3] += np.count_nonzero(very_high)
 
-    slightly_negative_count = int(np.sum(slightly_negative))
-    very_negative_count = int(np.sum(very_negative))
-    very_high_count = int(np.sum(very_high))
+        # FILTER 1: Negative Werte → 0 (stark negative werden danach entfernt)
+        np.putmask(chunk, negative, 0.0)
 
-    # FILTER 1: Leicht negative Werte → 0
-    chm_filtered[slightly_negative] = 0.0
+        # FILTER 2 + 3: Stark negative und sehr hohe Werte → NoData (eine kombinierte Maske)
+        # NaN-Pixel gleich mit auf NODATA setzen (NaN-Maske wiederverwenden)
+        remove_mask = np.logical_or(very_negative, very_high, out=very_negative)
+        remove_mask |= nan_mask
+        np.putmask(chunk, remove_mask, NODATA)
 
-    # FILTER 2: Stark negative Werte → NoData
-    chm_filtered[very_negative] = np.nan
+    return counts
 
-    # FILTER 3: Sehr hohe Werte → NoData
-    chm_filtered[very_high] = np.nan
 
-    # Nach-Filter-Statistiken
-    valid_mask_filtered = ~np.isnan(chm_filtered)
-    filtered_valid_count = valid_mask_filtered.sum()
-    removed_count = original_valid_count - filtered_valid_count
+def _filter_stats(total_pixels: int, counts: np.ndarray) -> dict:
+    """Berechnet die Filter-Statistiken aus den (aufsummierten) Zählern von _filter_chunks."""
+    nan_count, negative_count, very_negative_count, very_high_count = (int(c) for c in counts)
 
-    stats = {
+    # Masken sind disjunkt und enthalten nur gültige Pixel
+    original_valid_count = total_pixels - nan_count
+    slightly_negative_count = negative_count - very_negative_count
+    removed_count = very_negative_count + very_high_count
+    filtered_valid_count = original_valid_count - removed_count
+
+    return {
         "original_valid_pixels": int(original_valid_count),
         "filtered_valid_pixels": int(filtered_valid_count),
         "removed_pixels": int(removed_count),
@@ -96,13 +129,15 @@ def apply_chm_filters(chm: np.ndarray) -> tuple[np.ndarray, dict]:
         "very_high_removed": very_high_count,
     }
 
-    return chm_filtered, stats
-
 
 def harmonize_city(city: str) -> dict:
     """
     Harmonisiert CHM für eine Stadt.
 
+    Das CHM wird streifenweise (BLOCK_SIZE Zeilen) gelesen, gefiltert und in
+    eine temporäre Datei geschrieben, die danach das Original ersetzt. Das
+    Raster wird so nie vollständig in den Speicher geladen.
+
     Args:
         city: Stadtname
 
@@ -110,32 +145,59 @@ def harmonize_city(city: str) -> dict:
         Dict mit Statistiken
     """
     chm_path = CHM_PROCESSED_DIR / f"CHM_1m_{city}.tif"
+    tmp_path = chm_path.with_name(f"{chm_path.stem}.tmp{chm_path.suffix}")
 
     print(f"\n{'=' * 70}")
     print(f"Harmonisiere {city}")
     print(f"{'=' * 70}")
 
-    # 1. Lade CHM
-    print("\n[1/3] Lade CHM...")
+    print("\n[1/2] Filtere und speichere CHM streifenweise...")
+    print(f"  Filter 1: {SLIGHTLY_NEGATIVE_MIN:.1f}m bis 0m → 0")
+    print(f"  Filter 2: <{SLIGHTLY_NEGATIVE_MIN:.1f}m → NoData")
+    print(f"  Filter 3: >{MAX_REALISTIC_HEIGHT:.1f}m → NoData")
+
+    counts = np.zeros(4, dtype=np.int64)
+
     with rasterio.open(chm_path) as src:
-        chm = src.read(1)
         profile = src.profile.copy()
+        # Gemeinsame Schreibparameter (zstd, Prädiktor, Kacheln) aus der Konfiguration
+        profile.update(
+            dtype=rasterio.float32, nodata=NODATA, num_threads=GDAL_NUM_THREADS, **CHM_GTIFF_PROFILE
+        )
 
-        # NoData zu NaN
-        if src.nodata is not None:
-            chm = np.where(np.isclose(chm, src.nodata), np.nan, chm).astype(np.float32)
+        height, width = src.shape
+        print(f"  Shape: {src.shape}")
 
-    print(f"  Shape: {chm.shape}")
-    print(f"  Original gültige Pixel: {np.sum(~np.isnan(chm)):,}")
+        # Streifenpuffer einmal anlegen und für alle Kachelzeilen wiederverwenden
+        strip_buf = np.empty((BLOCK_SIZE, width), dtype=np.float32)
 
-    # 2. Wende Filter an
-    print("\n[2/3] Wende Filter an...")
-    print(f"  Filter 1: {SLIGHTLY_NEGATIVE_MIN:.1f}m bis 0m → 0")
-    print(f"  Filter 2: <{SLIGHTLY_NEGATIVE_MIN:.1f}m → NoData")
-    print(f"  Filter 3: >{MAX_REALISTIC_HEIGHT:.1f}m → NoData")
+        with rasterio.open(tmp_path, "w", **profile) as dst:
+            for row in range(0, height, BLOCK_SIZE):
+                window = Window(0, row, width, min(BLOCK_SIZE, height - row))
+                strip = src.read(1, window=window, out=strip_buf[:window.height])
+
+                # NoData zu NaN (in-place, exakter Vergleich nach float32-Cast)
+                if src.nodata is not None:
+                    np.putmask(strip, strip == np.float32(src.nodata), np.nan)
+
+                # Filtern und NaN zurück zu NoData in einem Durchgang (in-place)
+                counts += _filter_chunks(strip)
+
+                dst.write(strip, 1, window=window)
 
-    chm_filtered, stats = apply_chm_filters(chm)
+    # Interne Übersichten anlegen (Mittelwert, NoData wird ignoriert), damit
+    # grobe Ausschnitte und Vorschauen nicht das volle 1m-Raster dekodieren
+    with rasterio.Env(GDAL_NUM_THREADS=GDAL_NUM_THREADS), rasterio.open(tmp_path, "r+") as dst:
+        dst.build_overviews(OVERVIEW_FACTORS, Resampling.average)
+        dst.update_tags(ns="rio_overview", resampling="average")
 
+    # Original erst nach vollständigem Schreiben ersetzen (überschreibt Original!)
+    os.replace(tmp_path, chm_path)
+
+    stats = _filter_stats(height * width, counts)
+
+    # Gültige Pixel zählt der Filter-Durchgang mit (kein separater NaN-Scan)
+    print(f"\n  Original gültige Pixel: {stats['original_valid_pixels']:,}")
     print(f"\n  Ergebnis:")
     print(f"    Auf 0 gesetzt:        {stats['slightly_negative_set_to_zero']:>10,}")
     print(f"    Entfernt (negativ):   {stats['very_negative_removed']:>10,}")
@@ -143,26 +205,8 @@ def harmonize_city(city: str) -> dict:
     print(f"    Gesamt entfernt:      {stats['removed_pixels']:>10,} ({stats['removed_percent']:.2f}%)")
     print(f"    Verbleibend gültig:   {stats['filtered_valid_pixels']:>10,}")
 
-    # 3. Speichere harmonisierten CHM (überschreibt Original!)
-    print("\n[3/3] Speichere harmonisierten CHM...")
-
-    # NaN zurück zu NoData
-    chm_output = np.where(np.isnan(chm_filtered), NODATA, chm_filtered).astype(np.float32)
-
-    profile.update(
-        dtype=rasterio.float32,
-        nodata=NODATA,
-        compress="lzw",
-        tiled=True,
-        blockxsize=256,
-        blockysize=256,
-    )
-
-    with rasterio.open(chm_path, "w", **profile) as dst:
-        dst.write(chm_output, 1)
-
     file_size_mb = chm_path.stat().st_size / (1024**2)
-    print(f"  ✓ Gespeichert: {chm_path.name} ({file_size_mb:.1f} MB)")
+    print(f"\n[2/2] ✓ Gespeichert: {chm_path.name} ({file_size_mb:.1f} MB)")
 
     stats["city"] = city
     return stats
@@ -194,11 +238,8 @@ def main():
         print("\nAbgebrochen.")
         return
 
-    all_stats = []
-
-    for city in CITIES:
-        stats = harmonize_city(city)
-        all_stats.append(stats)
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        all_stats = list(executor.map(harmonize_city, CITIES))
 
     # Zusammenfassung
     print("\n")
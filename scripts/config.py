@@ -31,6 +31,28 @@ BOUNDARIES_PATH = BOUNDARIES_DIR / "city_boundaries.gpkg"
 BOUNDARIES_BUFFERED_PATH = BOUNDARIES_DIR / "city_boundaries_500m_buffer.gpkg"
 BUFFER_DISTANCE_M = 500
 
+
+def load_city_geometries(boundaries_path: Path = BOUNDARIES_PATH) -> dict:
+    """
+    Lädt die Stadtgrenzen einmalig und gibt die Geometrie je Stadt zurück.
+
+    Wird im Hauptprozess aufgerufen; Worker erhalten nur die Geometrien.
+    """
+    import geopandas as gpd  # lokal, damit die Konfiguration ohne Geo-Stack importierbar bleibt
+
+    boundaries = gpd.read_file(boundaries_path)
+    geoms_by_name = dict(zip(boundaries["gen"], boundaries.geometry.values))
+    return {city: geoms_by_name[city] for city in CITIES}
+
+
+def rasterize_city_mask(city_geom, out_shape: tuple[int, int], transform):
+    """Rasterisiert eine Stadtgrenze als Bool-Maske (True = innerhalb)."""
+    from rasterio.features import rasterize
+
+    return rasterize(
+        [(city_geom, 1)], out_shape=out_shape, transform=transform, dtype="uint8"
+    ).view(bool)
+
 # BKG WFS-Dienst
 BKG_WFS_URL = "https://sgx.geodatenzentrum.de/wfs_vg250"
 BKG_WFS_LAYER = "vg250:vg250_gem"
@@ -160,6 +182,19 @@ GDALWARP_OPTS = [
     "-co", "BIGTIFF=IF_SAFER",
 ]
 
+# Schreibparameter der CHM-GeoTIFFs (create_chm.py, harmonize_chm.py)
+CHM_NODATA = -9999.0
+CHM_BLOCK_SIZE = 256  # Kachelgröße (Lesen/Schreiben erfolgt in Kachelzeilen)
+CHM_GTIFF_PROFILE = {
+    "compress": "zstd",
+    "zstd_level": 1,  # Schnellste Stufe: kaum größer, deutlich schneller als LZW
+    "predictor": 3,  # Gleitkomma-Prädiktor (benachbarte Höhen dekorrelieren)
+    "tiled": True,
+    "blockxsize": CHM_BLOCK_SIZE,
+    "blockysize": CHM_BLOCK_SIZE,
+    "BIGTIFF": "IF_SAFER",
+}
+
 # Download-Parameter
 ELEVATION_MAX_RETRIES = 3
 ELEVATION_DOWNLOAD_TIMEOUT_S = 60
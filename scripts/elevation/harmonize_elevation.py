@@ -20,9 +20,11 @@ WICHTIG: Dieses Skript überschreibt die Originaldateien!
          Stelle sicher, dass ein Backup existiert.
 """
 
+import os
 import shutil
 import sys
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -37,6 +39,16 @@ from scripts.config import CHM_RAW_DIR, CITIES
 # Ziel-NoData Wert
 TARGET_NODATA = -9999.0
 
+# Parallele Städte (konservativ: jede Stadt hält DOM/DGM vollständig im Speicher)
+MAX_WORKERS = min(len(CITIES), max(1, (os.cpu_count() or 1) // 4))
+
+# Warp-Parameter (multithreaded Resampling, Kerne auf die parallelen Städte verteilt)
+WARP_NUM_THREADS = max(1, ((os.cpu_count() or 1) - 1) // MAX_WORKERS)
+WARP_MEM_LIMIT_MB = 512
+GDAL_CACHEMAX_MB = 512
+# Max. Fehler des approximierten (stückweise linearen) Transformers in Pixeln
+WARP_APPROX_TOLERANCE_PX = 0.125
+
 
 def harmonize_nodata_berlin(src_path: Path, dst_path: Path, data_type: str) -> dict:
     """
@@ -46,7 +58,7 @@ def harmonize_nodata_berlin(src_path: Path, dst_path: Path, data_type: str) -> d
     daher gibt es keine validen 0m-Werte. Wir konvertieren 0 → -9999.
     """
     with rasterio.open(src_path) as src:
-        data = src.read(1)
+        data = src.read(1, out_dtype=np.float32)
         profile = src.profile.copy()
 
         original_nodata = src.nodata
@@ -55,8 +67,9 @@ def harmonize_nodata_berlin(src_path: Path, dst_path: Path, data_type: str) -> d
         nodata_mask = data == 0
         valid_before = (~nodata_mask).sum()
 
-        # Konvertiere 0 → -9999
-        output_data = np.where(nodata_mask, TARGET_NODATA, data).astype(np.float32)
+        # Konvertiere 0 → -9999 (in-place)
+        np.putmask(data, nodata_mask, TARGET_NODATA)
+        output_data = data
         valid_after = (output_data != TARGET_NODATA).sum()
 
         profile.update(
@@ -87,7 +100,7 @@ def harmonize_nodata_hamburg(src_path: Path, dst_path: Path, data_type: str) ->
     Hamburg DGM hat NoData=-32768.
     """
     with rasterio.open(src_path) as src:
-        data = src.read(1)
+        data = src.read(1, out_dtype=np.float32)
         profile = src.profile.copy()
 
         original_nodata = src.nodata
@@ -96,18 +109,19 @@ def harmonize_nodata_hamburg(src_path: Path, dst_path: Path, data_type: str) ->
         if original_nodata is None:
             # DOM: Kein NoData definiert, alle Pixel sind valid
             # Setze NoData-Wert für Konsistenz, aber ändere keine Daten
-            output_data = data.astype(np.float32)
+            output_data = data
             valid_before = total_pixels
             valid_after = total_pixels
         elif np.isclose(original_nodata, -32768):
             # DGM: NoData=-32768, konvertiere zu -9999
-            nodata_mask = np.isclose(data, original_nodata)
+            nodata_mask = data == np.float32(original_nodata)
             valid_before = (~nodata_mask).sum()
-            output_data = np.where(nodata_mask, TARGET_NODATA, data).astype(np.float32)
+            np.putmask(data, nodata_mask, TARGET_NODATA)
+            output_data = data
             valid_after = (output_data != TARGET_NODATA).sum()
         else:
             # Unerwarteter NoData-Wert
-            output_data = data.astype(np.float32)
+            output_data = data
             valid_before = total_pixels
             valid_after = total_pixels
 
@@ -136,19 +150,19 @@ def harmonize_nodata_rostock(src_path: Path, dst_path: Path, data_type: str) ->
     Rostock: NoData bereits -9999, nur Profil-Update und Copy.
     """
     with rasterio.open(src_path) as src:
-        data = src.read(1)
+        data = src.read(1, out_dtype=np.float32)
         profile = src.profile.copy()
 
         original_nodata = src.nodata
 
         # Zähle NoData-Pixel
         if original_nodata is not None:
-            nodata_mask = np.isclose(data, original_nodata)
+            nodata_mask = data == np.float32(original_nodata)
             valid_before = (~nodata_mask).sum()
         else:
             valid_before = data.size
 
-        output_data = data.astype(np.float32)
+        output_data = data
         valid_after = (output_data != TARGET_NODATA).sum()
 
         profile.update(
@@ -171,12 +185,59 @@ def harmonize_nodata_rostock(src_path: Path, dst_path: Path, data_type: str) ->
     }
 
 
+def _integer_pixel_offset(src_transform, dst_transform, tol: float = 1e-6) -> tuple[int, int] | None:
+    """
+    Ganzzahliger Pixel-Versatz (Zeile, Spalte) des Quell-Grids im Ziel-Grid.
+
+    Gibt None zurück, wenn Pixelgröße oder Rotation abweichen oder der
+    Versatz kein ganzzahliges Vielfaches der Pixelgröße ist.
+    """
+    if src_transform.b or src_transform.d or dst_transform.b or dst_transform.d:
+        return None
+    if abs(src_transform.a - dst_transform.a) > tol or abs(src_transform.e - dst_transform.e) > tol:
+        return None
+
+    col = (src_transform.c - dst_transform.c) / dst_transform.a
+    row = (src_transform.f - dst_transform.f) / dst_transform.e
+    if abs(col - round(col)) > tol or abs(row - round(row)) > tol:
+        return None
+
+    return round(row), round(col)
+
+
+def _copy_aligned(
+    src_data: np.ndarray,
+    dst_data: np.ndarray,
+    pixel_offset: tuple[int, int],
+    src_nodata: float | None,
+) -> None:
+    """
+    Kopiert ein deckungsgleiches Quell-Array (mit Pixel-Versatz) in das Ziel-Array.
+
+    Nicht überlappende Bereiche behalten den Füllwert des Ziel-Arrays,
+    Quell-NoData wird auf TARGET_NODATA gesetzt.
+    """
+    row, col = pixel_offset
+    dst_r0, dst_c0 = max(row, 0), max(col, 0)
+    dst_r1 = min(row + src_data.shape[0], dst_data.shape[0])
+    dst_c1 = min(col + src_data.shape[1], dst_data.shape[1])
+    if dst_r1 <= dst_r0 or dst_c1 <= dst_c0:
+        return
+
+    target = dst_data[dst_r0:dst_r1, dst_c0:dst_c1]
+    target[...] = src_data[dst_r0 - row:dst_r1 - row, dst_c0 - col:dst_c1 - col]
+    if src_nodata is not None:
+        np.putmask(target, target == target.dtype.type(src_nodata), TARGET_NODATA)
+
+
 def align_dgm_to_dom(dom_path: Path, dgm_path: Path, output_path: Path) -> dict:
     """
     Aligniert DGM auf DOM-Grid mit bilinearem Resampling.
 
     DOM dient als Referenz (bessere Coverage).
     DGM wird auf exakt gleiche Dimensionen, Transform und CRS gebracht.
+    Sind die Grids bereits deckungsgleich (gleiches CRS und gleiche Pixelgröße,
+    ganzzahliger Versatz), wird nur ausgeschnitten/aufgefüllt.
     """
     with rasterio.open(dom_path) as dom_src:
         dom_shape = (dom_src.height, dom_src.width)
@@ -184,7 +245,7 @@ def align_dgm_to_dom(dom_path: Path, dgm_path: Path, output_path: Path) -> dict:
         dom_crs = dom_src.crs
         dom_bounds = dom_src.bounds
 
-    with rasterio.open(dgm_path) as dgm_src:
+    with rasterio.Env(GDAL_CACHEMAX=GDAL_CACHEMAX_MB), rasterio.open(dgm_path) as dgm_src:
         dgm_data = dgm_src.read(1)
         dgm_shape_before = (dgm_src.height, dgm_src.width)
         dgm_nodata = dgm_src.nodata
@@ -192,19 +253,32 @@ def align_dgm_to_dom(dom_path: Path, dgm_path: Path, output_path: Path) -> dict:
         # Erstelle Output-Array mit NoData gefüllt
         output_data = np.full(dom_shape, TARGET_NODATA, dtype=np.float32)
 
-        # Reproject DGM auf DOM-Grid
-        reproject(
-            source=dgm_data,
-            destination=output_data,
-            src_transform=dgm_src.transform,
-            src_crs=dgm_src.crs,
-            src_nodata=dgm_nodata,
-            dst_transform=dom_transform,
-            dst_crs=dom_crs,
-            dst_nodata=TARGET_NODATA,
-            resampling=Resampling.bilinear,
+        pixel_offset = (
+            _integer_pixel_offset(dgm_src.transform, dom_transform)
+            if dgm_src.crs == dom_crs
+            else None
         )
 
+        if pixel_offset is not None:
+            # Grids sind deckungsgleich: nur ausschneiden/auffüllen statt Resampling
+            _copy_aligned(dgm_data, output_data, pixel_offset, dgm_nodata)
+        else:
+            # Reproject DGM auf DOM-Grid
+            reproject(
+                source=dgm_data,
+                destination=output_data,
+                src_transform=dgm_src.transform,
+                src_crs=dgm_src.crs,
+                src_nodata=dgm_nodata,
+                dst_transform=dom_transform,
+                dst_crs=dom_crs,
+                dst_nodata=TARGET_NODATA,
+                resampling=Resampling.bilinear,
+                num_threads=WARP_NUM_THREADS,
+                warp_mem_limit=WARP_MEM_LIMIT_MB,
+                tolerance=WARP_APPROX_TOLERANCE_PX,
+            )
+
     # Schreibe aligniertes DGM
     profile = {
         "driver": "GTiff",
@@ -314,6 +388,15 @@ def harmonize_city(city: str) -> dict:
     return results
 
 
+def _harmonize_city_safe(city: str) -> dict:
+    """Wie harmonize_city, liefert Fehler aber als Ergebnis statt als Exception."""
+    try:
+        return harmonize_city(city)
+    except Exception as e:
+        print(f"\n✗ FEHLER bei {city}: {e}")
+        return {"error": str(e)}
+
+
 def main():
     """Hauptfunktion: Harmonisiert alle Städte."""
     print("=" * 70)
@@ -324,15 +407,8 @@ def main():
     print("         Stelle sicher, dass ein Backup existiert.")
     print()
 
-    all_results = {}
-
-    for city in CITIES:
-        try:
-            results = harmonize_city(city)
-            all_results[city] = results
-        except Exception as e:
-            print(f"\n✗ FEHLER bei {city}: {e}")
-            all_results[city] = {"error": str(e)}
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        all_results = dict(zip(CITIES, executor.map(_harmonize_city_safe, CITIES)))
 
     # Zusammenfassung
     print("\n")
@@ -14,23 +14,66 @@ Validiert Höhendaten (DOM und DGM) für alle drei Städte.
 import sys
 from pathlib import Path
 
-import geopandas as gpd
 import numpy as np
 import rasterio
-from rasterio.features import geometry_mask
+from rasterio.errors import WindowError
+from rasterio.features import geometry_window
+from rasterio.windows import Window
 
 # Add parent directory to path for imports
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
 from scripts.config import (
-    BOUNDARIES_PATH,
     CHM_RAW_DIR,
     CITIES,
     ELEVATION_RESOLUTION_M,
     TARGET_CRS,
+    load_city_geometries,
+    rasterize_city_mask,
 )
 
 
+def city_window(src, city_geom) -> Window | None:
+    """
+    Fenster der Bounding Box der Stadtgrenze, auf die Rasterausdehnung begrenzt.
+
+    Returns:
+        Window oder None, falls die Stadtgrenze das Raster nicht überlappt
+    """
+    window = geometry_window(src, [city_geom], boundless=True)
+    try:
+        window = window.intersection(Window(0, 0, src.width, src.height))
+    except WindowError:
+        return None
+    if window.width <= 0 or window.height <= 0:
+        return None
+    return window
+
+
+def read_within_city(src, city_geom, window=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Liest nur die Bounding Box der Stadtgrenze und rasterisiert die Maske
+    über diesem Fenster statt über das gesamte (gepufferte) Raster.
+
+    Args:
+        src: Geöffnetes Raster
+        city_geom: Stadtgrenze (ohne Buffer)
+        window: Optional vorgegebenes Fenster (z.B. eines deckungsgleichen Rasters)
+
+    Returns:
+        Tuple (data, inside_mask) - Rasterausschnitt (float32) und Maske
+        (True = innerhalb Stadtgrenze); leer, falls die Stadtgrenze das Raster
+        nicht überlappt
+    """
+    if window is None:
+        window = city_window(src, city_geom)
+    if window is None:
+        return np.empty((0, 0), dtype=np.float32), np.zeros((0, 0), dtype=bool)
+    data = src.read(1, window=window, out_dtype=np.float32)
+    inside_mask = rasterize_city_mask(city_geom, data.shape, src.window_transform(window))
+    return data, inside_mask
+
+
 def validate_elevation_files() -> None:
     """Validiert alle Elevation-Dateien."""
     print("=" * 90)
@@ -39,7 +82,7 @@ def validate_elevation_files() -> None:
     print()
 
     # Lade Stadtgrenzen (OHNE Buffer) für Coverage-Berechnung
-    boundaries = gpd.read_file(BOUNDARIES_PATH)
+    city_geoms = load_city_geometries()
 
     # CHECK 1: Dateiexistenz
     print("CHECK 1: File Existence and Size")
@@ -116,7 +159,7 @@ def validate_elevation_files() -> None:
     print("CHECK 4: Data Range and Statistics (within city boundaries)")
     print("-" * 90)
     for city in CITIES:
-        city_geom = boundaries[boundaries["gen"] == city].geometry.iloc[0]
+        city_geom = city_geoms[city]
         
         for data_type in ["DOM", "DGM"]:
             path = CHM_RAW_DIR / city.lower() / f"{data_type.lower()}_1m.tif"
@@ -125,17 +168,13 @@ def validate_elevation_files() -> None:
                 continue
 
             with rasterio.open(path) as src:
-                data = src.read(1)
+                # Ausschnitt und Maske für Pixel innerhalb der Stadtgrenze
+                data, inside_mask = read_within_city(src, city_geom)
                 nodata = src.nodata
                 
-                # Maske für Pixel innerhalb der Stadtgrenze
-                inside_mask = ~geometry_mask(
-                    [city_geom], out_shape=data.shape, transform=src.transform
-                )
-                
                 # NoData zu NaN konvertieren
                 if nodata is not None:
-                    data = np.where(np.isclose(data, nodata), np.nan, data).astype(np.float32)
+                    np.putmask(data, data == np.float32(nodata), np.nan)
                 
                 # Nur Pixel innerhalb der Stadtgrenze
                 data_inside = data[inside_mask]
@@ -145,12 +184,17 @@ def validate_elevation_files() -> None:
                     print(f"  ✗ {city} {data_type:3} - No valid data")
                     continue
 
-                # Statistiken
-                min_val = float(np.min(valid_values))
-                max_val = float(np.max(valid_values))
+                # Statistiken (Mittelwert/Std vor der In-place-Partitionierung)
                 mean_val = float(np.mean(valid_values))
                 std_val = float(np.std(valid_values))
-                median_val = float(np.median(valid_values))
+
+                # Min, Max und Median aus einer einzigen Partitionierung
+                n = valid_values.size
+                mid_low, mid_high = (n - 1) // 2, n // 2
+                valid_values.partition([0, mid_low, mid_high, n - 1])
+                min_val = float(valid_values[0])
+                max_val = float(valid_values[-1])
+                median_val = (float(valid_values[mid_low]) + float(valid_values[mid_high])) / 2
 
                 # Überprüfe auf negative Werte (sollte nicht vorkommen)
                 negative_count = int(np.sum(valid_values < 0))
@@ -168,7 +212,7 @@ def validate_elevation_files() -> None:
     print("CHECK 5: NoData Handling (within city boundaries)")
     print("-" * 90)
     for city in CITIES:
-        city_geom = boundaries[boundaries["gen"] == city].geometry.iloc[0]
+        city_geom = city_geoms[city]
 
         for data_type in ["DOM", "DGM"]:
             path = CHM_RAW_DIR / city.lower() / f"{data_type.lower()}_1m.tif"
@@ -178,17 +222,14 @@ def validate_elevation_files() -> None:
 
             with rasterio.open(path) as src:
                 nodata = src.nodata
-                data = src.read(1)
 
-                # Maske für Pixel innerhalb der Stadtgrenze
-                inside_mask = ~geometry_mask(
-                    [city_geom], out_shape=data.shape, transform=src.transform
-                )
+                # Ausschnitt und Maske für Pixel innerhalb der Stadtgrenze
+                data, inside_mask = read_within_city(src, city_geom)
                 pixels_inside = inside_mask.sum()
 
                 # NoData-Pixel identifizieren
                 if nodata is not None:
-                    is_nodata = np.isclose(data, nodata)
+                    is_nodata = data == np.float32(nodata)
                 else:
                     is_nodata = np.zeros_like(data, dtype=bool)
 
@@ -208,7 +249,7 @@ def validate_elevation_files() -> None:
     print("CHECK 6: DOM >= DGM Sanity Check (within city boundaries)")
     print("-" * 90)
     for city in CITIES:
-        city_geom = boundaries[boundaries["gen"] == city].geometry.iloc[0]
+        city_geom = city_geoms[city]
         dom_path = CHM_RAW_DIR / city.lower() / "dom_1m.tif"
         dgm_path = CHM_RAW_DIR / city.lower() / "dgm_1m.tif"
 
@@ -217,37 +258,54 @@ def validate_elevation_files() -> None:
             continue
 
         with rasterio.open(dom_path) as dom_src, rasterio.open(dgm_path) as dgm_src:
-            dom_data = dom_src.read(1)
-            dgm_data = dgm_src.read(1)
+            # Nur pixelweise vergleichen, wenn beide Raster auf demselben Grid liegen
+            if dom_src.shape != dgm_src.shape or not dom_src.transform.almost_equals(
+                dgm_src.transform, precision=1e-6
+            ):
+                print(
+                    f"  ✗ {city:10}  Grid mismatch (DOM {dom_src.shape} vs DGM {dgm_src.shape}) "
+                    "- run harmonize_elevation.py first"
+                )
+                continue
+
+            # Ausschnitt und Maske für Pixel innerhalb der Stadtgrenze (DGM im selben Fenster)
+            window = city_window(dom_src, city_geom)
+            if window is None:
+                print(f"  ✗ {city:10}  No valid overlapping pixels")
+                continue
+            dom_data, inside_mask = read_within_city(dom_src, city_geom, window)
+            dgm_data = dgm_src.read(1, window=window, out_dtype=np.float32)
             dom_nodata = dom_src.nodata
             dgm_nodata = dgm_src.nodata
             
-            # Maske für Pixel innerhalb der Stadtgrenze
-            inside_mask = ~geometry_mask(
-                [city_geom], out_shape=dom_data.shape, transform=dom_src.transform
-            )
-            
-            # NoData zu NaN konvertieren
+            # NoData zu NaN konvertieren (in-place, float32)
             if dom_nodata is not None:
-                dom_data = np.where(np.isclose(dom_data, dom_nodata), np.nan, dom_data).astype(np.float32)
+                np.putmask(dom_data, dom_data == np.float32(dom_nodata), np.nan)
             if dgm_nodata is not None:
-                dgm_data = np.where(np.isclose(dgm_data, dgm_nodata), np.nan, dgm_data).astype(np.float32)
+                np.putmask(dgm_data, dgm_data == np.float32(dgm_nodata), np.nan)
+
+            # Differenz in-place im DOM-Puffer (NaN in DOM oder DGM propagiert)
+            diff_full = np.subtract(dom_data, dgm_data, out=dom_data)
+            del dgm_data
 
-            # Vergleich nur wo beide gültig UND innerhalb Stadtgrenze
-            valid_mask = inside_mask & (~np.isnan(dom_data)) & (~np.isnan(dgm_data))
-            valid_count = valid_mask.sum()
+            # Vergleich nur wo beide gültig UND innerhalb Stadtgrenze (ein Bool-Puffer)
+            valid_mask = np.isnan(diff_full)
+            np.logical_not(valid_mask, out=valid_mask)
+            valid_mask &= inside_mask
+            valid_count = int(np.count_nonzero(valid_mask))
 
             if valid_count > 0:
-                diff = dom_data[valid_mask] - dgm_data[valid_mask]
+                diff = diff_full[valid_mask]
 
                 # DOM sollte >= DGM sein (DOM hat Vegetation/Gebäude)
-                dom_lt_dgm_count = int(np.sum(diff < -0.1))  # -0.1m Toleranz
+                below_mask = diff < -0.1  # -0.1m Toleranz
+                dom_lt_dgm_count = int(np.count_nonzero(below_mask))
                 dom_gte_dgm_pct = (valid_count - dom_lt_dgm_count) / valid_count * 100
                 mean_diff = float(np.mean(diff))
                 
                 # Zusätzliche Statistiken für negative Differenzen
                 if dom_lt_dgm_count > 0:
-                    neg_diff = diff[diff < -0.1]
+                    neg_diff = diff[below_mask]
                     min_neg_diff = float(np.min(neg_diff))
                     mean_neg_diff = float(np.mean(neg_diff))
 
@@ -270,7 +328,7 @@ def validate_elevation_files() -> None:
 
     for city in CITIES:
         print(f"  {city}:")
-        city_geom = boundaries[boundaries["gen"] == city].geometry.iloc[0]
+        city_geom = city_geoms[city]
         total_valid = 0
         pixels_inside_total = 0
 
@@ -281,18 +339,15 @@ def validate_elevation_files() -> None:
                 continue
 
             with rasterio.open(path) as src:
-                data = src.read(1)
                 nodata = src.nodata
 
-                # Maske für Pixel innerhalb der Stadtgrenze
-                inside_mask = ~geometry_mask(
-                    [city_geom], out_shape=data.shape, transform=src.transform
-                )
+                # Ausschnitt und Maske für Pixel innerhalb der Stadtgrenze
+                data, inside_mask = read_within_city(src, city_geom)
                 pixels_inside = inside_mask.sum()
 
                 # NoData-Pixel identifizieren
                 if nodata is not None:
-                    is_nodata = np.isclose(data, nodata)
+                    is_nodata = data == np.float32(nodata)
                 else:
                     is_nodata = np.zeros_like(data, dtype=bool)
 